@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Rendering benchmarks for raven.
+
+    python bench_raven.py [renders]
+
+Runs each mode in its own process so the peak RSS numbers are comparable.
+"""
+import sys
+import time
+import resource
+import subprocess
+
+import raven
+from raven import *
+
+def render_workload(n):
+    f = ColoredLinedShapeFigure([TripleShapeFeatureSet,
+                                 TripleColorFeatureSet,
+                                 TripleSmallPositiveIntegerFeatureSet,],
+                                    [[Triangle, Square, Circle],
+                                     [Yellow, Blue, Red],
+                                     [V2, V8, V16]])
+    cmatrix = cmatrix_from_two_transitions(f, [2,1,0], [1,1,1], [2,1,2])
+    for i in xrange(n):
+        rpm_images(f, cmatrix, [[0,0,0], [1,1,1]])
+
+def run_mode(mode, n):
+    if mode == 'fresh':
+        # the path before pooling: a new surface and context every time
+        @contextmanager
+        def fresh_cairo_surface(width, height, color=cairo.FORMAT_ARGB32):
+            yield create_cairo_surface(width, height, color)
+        raven.pooled_cairo_surface = fresh_cairo_surface
+    start = time.time()
+    render_workload(n)
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    stats = raven.surface_pool.stats()
+    print '%-6s %6d grids %8.1f grids/s  maxrss %7d kB  pool %s' % (
+                mode, n, n / elapsed, rss, stats)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        run_mode(sys.argv[2], int(sys.argv[1]))
+    else:
+        n = sys.argv[1] if len(sys.argv) > 1 else '200'
+        for mode in ['fresh', 'pooled']:
+            subprocess.check_call([sys.executable, __file__, n, mode])
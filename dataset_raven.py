@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Fixed-shape training datasets of raven puzzles on numpy.memmap.
+
+    python dataset_raven.py path n [--choices 8] [--seed 0] [--processes 4]
+
+A dataset is a directory holding
+
+    spec.json     shapes and dtypes of the arrays below
+    context.u8    (N, 9, H, W) uint8 grayscale cells, the ninth one blank
+    choices.u8    (N, K, H, W) uint8 grayscale candidate answers
+    answers.u8    (N,) uint8 index of the right candidate
+
+The arrays are preallocated by create_dataset and filled by fill_dataset,
+a chunk at a time, so several processes can fill disjoint index ranges of
+the same dataset. open_dataset maps them read-only for random access.
+Puzzle i is always generated from seed + i, whichever process builds it.
+"""
+import os
+import argparse
+import StringIO
+import multiprocessing
+
+import numpy
+import cairo
+import simplejson
+
+from raven import *
+
+spec_file = 'spec.json'
+
+def dataset_spec(n, k, height=figure_size, width=figure_size):
+    return {'n': n,
+            'choices': k,
+            'height': height,
+            'width': width,
+            'arrays': {
+                'context': {'file': 'context.u8', 'dtype': 'uint8',
+                            'shape': [n, 9, height, width]},
+                'choices': {'file': 'choices.u8', 'dtype': 'uint8',
+                            'shape': [n, k, height, width]},
+                'answers': {'file': 'answers.u8', 'dtype': 'uint8',
+                            'shape': [n]},
+            }}
+
+def create_dataset(path, n, k=8):
+    assert(0 < k <= 255)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    spec = dataset_spec(n, k)
+    for name, a in spec['arrays'].items():
+        m = numpy.memmap(os.path.join(path, a['file']), dtype=a['dtype'],
+                         mode='w+', shape=tuple(a['shape']))
+        m.flush()
+        del m
+    with open(os.path.join(path, spec_file), 'w') as f:
+        simplejson.dump(spec, f, indent=2, sort_keys=True)
+    return spec
+
+def open_dataset(path, mode='r'):
+    """Returns the spec and a dict of memmaps, one per array."""
+    with open(os.path.join(path, spec_file)) as f:
+        spec = simplejson.load(f)
+    arrays = dict((name, numpy.memmap(os.path.join(path, a['file']),
+                                      dtype=a['dtype'], mode=mode,
+                                      shape=tuple(a['shape'])))
+                        for name, a in spec['arrays'].items())
+    return spec, arrays
+
+def gray_from_png(png):
+    """Decodes a png cell to uint8 luminance, composited over white."""
+    s = cairo.ImageSurface.create_from_png(StringIO.StringIO(png))
+    assert(s.get_format() == cairo.FORMAT_ARGB32)
+    h, w, stride = s.get_height(), s.get_width(), s.get_stride()
+    data = numpy.frombuffer(s.get_data(), numpy.uint8)
+    # native-endian premultiplied ARGB32 is B, G, R, A in memory
+    bgra = data.reshape(h, stride)[:, :w * 4].reshape(h, w, 4).astype(numpy.float32)
+    white = 255.0 - bgra[:, :, 3]
+    gray = (0.114 * (bgra[:, :, 0] + white) +
+            0.587 * (bgra[:, :, 1] + white) +
+            0.299 * (bgra[:, :, 2] + white))
+    return numpy.clip(numpy.round(gray), 0, 255).astype(numpy.uint8)
+
+def pick_distractors(distractors, count):
+    """count distractors; all distinct ones first, then repeats if short."""
+    n = len(distractors)
+    if n >= count:
+        picked = numpy.random.choice(n, count, replace=False)
+    else:
+        picked = numpy.concatenate([numpy.arange(n),
+                                    numpy.random.choice(n, count - n)])
+        numpy.random.shuffle(picked)
+    return [distractors[i] for i in picked]
+
+def puzzle_pngs(seed, k, world=world):
+    """Renders one puzzle: 9 context pngs, k choice pngs, answer index."""
+    numpy.random.seed(seed % 2**32)
+    spec = random_matrix(*world)
+    f = spec['fg'](spec['fs'], spec['f'])
+    c, t1, t2 = spec['c'], spec['t1'], spec['t2']
+    cmatrix = cmatrix_from_two_transitions(f, c, t1, t2)
+    answer = cmatrix[2][2]
+    distractors = generate_choices(f, c, t1, t2, answer)
+    if not distractors:
+        distractors = other_configurations(f, answer)
+    choices = pick_distractors(distractors, k - 1)
+    answer_index = numpy.random.randint(0, k)
+    choices.insert(answer_index, answer)
+    return (rpm_guess_pngs(f, cmatrix),
+            [f.render(i) for i in choices],
+            answer_index)
+
+def fill_dataset(path, start, stop, seed=0, chunk_size=128):
+    """Generates puzzles start..stop-1 into an existing dataset.
+
+    Only chunk_size puzzles are held in memory at a time.
+    """
+    spec, arrays = open_dataset(path, mode='r+')
+    k, h, w = spec['choices'], spec['height'], spec['width']
+    assert(0 <= start <= stop <= spec['n'])
+    for chunk_start in xrange(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        size = chunk_stop - chunk_start
+        context = numpy.empty((size, 9, h, w), numpy.uint8)
+        choices = numpy.empty((size, k, h, w), numpy.uint8)
+        answers = numpy.empty((size,), numpy.uint8)
+        for j in xrange(size):
+            context_pngs, choice_pngs, answers[j] = puzzle_pngs(seed + chunk_start + j, k)
+            for i, png in enumerate(context_pngs):
+                context[j, i] = gray_from_png(png)
+            for i, png in enumerate(choice_pngs):
+                choices[j, i] = gray_from_png(png)
+        arrays['context'][chunk_start:chunk_stop] = context
+        arrays['choices'][chunk_start:chunk_stop] = choices
+        arrays['answers'][chunk_start:chunk_stop] = answers
+        for m in arrays.values():
+            m.flush()
+
+def _fill_range(args):
+    fill_dataset(*args)
+
+def build_dataset(path, n, k=8, seed=0, processes=1, chunk_size=128):
+    create_dataset(path, n, k)
+    step = max(chunk_size, -(-n // max(processes, 1)))
+    ranges = [(path, i, min(i + step, n), seed, chunk_size)
+                for i in xrange(0, n, step)]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_fill_range, ranges)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for r in ranges:
+            _fill_range(r)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a memmap raven dataset')
+    parser.add_argument('path')
+    parser.add_argument('n', type=int)
+    parser.add_argument('--choices', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=128)
+    args = parser.parse_args()
+    build_dataset(args.path, args.n, args.choices, args.seed,
+                  args.processes, args.chunk_size)
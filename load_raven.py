@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""Session-replay load test for web_raven.
+
+    python load_raven.py [--sessions 200] [--concurrency 4] [--ids 50]
+                         [--skew 1.1] [--seed 0] [--url http://host:port]
+                         [--json report.json]
+
+A session is what a browser does: GET /generate_random_matrix, follow the
+redirect to ask_matrix, fetch every matrix_guess/figure_image it links to
+and POST an answer. Without --url the wrapped app is driven in-process.
+
+Matrix popularity is skewed: the first --ids redirects fill a catalogue
+and later sessions ask for catalogue entries picked with zipf(--skew)
+weights instead of the fresh redirect, so repeat visits look like real
+traffic. The report is sorted json. With --concurrency 1 runs with the
+same seed make the same requests, so their reports diff cleanly. With
+more threads, scheduling decides which matrices fill the catalogue and
+in which order the app draws from numpy's global random state, so only
+the aggregate numbers are comparable between runs.
+"""
+import re
+import sys
+import time
+import bisect
+import random
+import urllib
+import urlparse
+import httplib
+import argparse
+import threading
+import StringIO
+from wsgiref.util import setup_testing_defaults
+
+import simplejson
+
+
+def endpoint(path):
+    return path.lstrip('/').split('/')[0].split('?')[0] or 'index'
+
+def wsgi_app():
+    import webify
+    from webify.middleware import SettingsMiddleware
+    import web_raven
+    settings = {'fff': [web_raven.all_figures,
+                        web_raven.all_feature_sets,
+                        web_raven.all_features]}
+    wsgi_app = webify.wsgify(web_raven.app, SettingsMiddleware(settings))
+    return web_raven.PngStreamMiddleware(wsgi_app, web_raven.render_cache)
+
+class WsgiClient(object):
+    """Calls a wsgi app directly, without a socket."""
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body=None):
+        path, _, query = path.partition('?')
+        environ = {'REQUEST_METHOD': method,
+                   'PATH_INFO': urllib.unquote(path),
+                   'QUERY_STRING': query,
+                   'wsgi.input': StringIO.StringIO(body or '')}
+        if body is not None:
+            environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+            environ['CONTENT_LENGTH'] = str(len(body))
+        setup_testing_defaults(environ)
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+            response['headers'] = dict((k.lower(), v) for k,v in headers)
+        result = self.app(environ, start_response)
+        try:
+            content = ''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], content
+
+    def cache_stats(self):
+        import web_raven
+        return web_raven.render_cache.stats()
+
+class HttpClient(object):
+    """Talks to a running server, one keep-alive connection per thread."""
+    def __init__(self, url):
+        parsed = urlparse.urlparse(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = httplib.HTTPConnection(self.host, self.port)
+        headers = {}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        connection = self.local.connection
+        try:
+            connection.request(method, path, body, headers)
+            r = connection.getresponse()
+            content = r.read()
+        except (httplib.HTTPException, IOError):
+            del self.local.connection
+            raise
+        return r.status, dict(r.getheaders()), content
+
+    def cache_stats(self):
+        return None
+
+class Catalogue(object):
+    """Matrix paths with zipf popularity over their insertion rank."""
+    def __init__(self, size, skew):
+        self.size = size
+        self.paths = []
+        self.lock = threading.Lock()
+        weights = [1.0 / (rank + 1) ** skew for rank in xrange(size)]
+        total = sum(weights)
+        self.cumulative = []
+        running = 0.0
+        for w in weights:
+            running += w / total
+            self.cumulative.append(running)
+
+    def pick(self, fresh, rng):
+        with self.lock:
+            if len(self.paths) < self.size or not self.size:
+                if self.size:
+                    self.paths.append(fresh)
+                return fresh
+        i = bisect.bisect_left(self.cumulative, rng.random())
+        return self.paths[min(i, self.size - 1)]
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.seen = set()
+        self.repeats = {}
+
+    def request(self, client, method, path, body=None):
+        """Times one request; a raised error counts as a failed request."""
+        start = time.time()
+        try:
+            status, headers, content = client.request(method, path, body)
+        except Exception:
+            status, headers, content = None, {}, ''
+        elapsed = time.time() - start
+        name = endpoint(path)
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            if status is None or status >= 400:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            if method == 'GET':
+                key = (name, path in self.seen)
+                self.repeats[key] = self.repeats.get(key, 0) + 1
+                self.seen.add(path)
+        return status, headers, content
+
+def run_session(client, recorder, catalogue, rng):
+    status, headers, _ = recorder.request(client, 'GET', '/generate_random_matrix')
+    if 'location' not in headers:
+        return
+    location = urlparse.urlparse(headers['location'])
+    fresh = location.path + (location.query and '?' + location.query)
+    path = catalogue.pick(fresh, rng)
+    status, _, page = recorder.request(client, 'GET', path)
+    if status != 200:
+        return
+    for link in re.findall(r'src="(.*?)"', page):
+        recorder.request(client, 'GET', link)
+    choices = [m.group(1) for m in
+                [re.search(r'value="(.*?)"', tag)
+                    for tag in re.findall(r'<input[^>]*name="figure"[^>]*>', page)]
+                if m]
+    if choices:
+        body = urllib.urlencode({'figure': rng.choice(choices)})
+        recorder.request(client, 'POST', path, body)
+
+def percentile(ordered, p):
+    return ordered[max(int(round(p / 100.0 * len(ordered))) - 1, 0)]
+
+def report(recorder, elapsed):
+    endpoints = {}
+    for name, latencies in recorder.latencies.items():
+        ordered = sorted(latencies)
+        hits = recorder.repeats.get((name, True), 0)
+        gets = hits + recorder.repeats.get((name, False), 0)
+        endpoints[name] = {
+            'requests': len(ordered),
+            'rps': round(len(ordered) / elapsed, 2),
+            'p50_ms': round(percentile(ordered, 50) * 1000, 2),
+            'p95_ms': round(percentile(ordered, 95) * 1000, 2),
+            'p99_ms': round(percentile(ordered, 99) * 1000, 2),
+            'errors': recorder.errors.get(name, 0),
+            # share of GETs for a url already fetched, i.e. what a
+            # response cache keyed by url could have served
+            'repeat_rate': round(hits / float(gets), 4) if gets else 0.0,
+        }
+    total = sum(e['requests'] for e in endpoints.values())
+    return {'elapsed_s': round(elapsed, 3),
+            'requests': total,
+            'rps': round(total / elapsed, 2),
+            'endpoints': endpoints}
+
+def run(client, sessions, concurrency, ids, skew, seed):
+    recorder = Recorder()
+    catalogue = Catalogue(ids, skew)
+    counter = iter(xrange(sessions))
+    counter_lock = threading.Lock()
+    def worker():
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            run_session(client, recorder, catalogue, random.Random(seed + i))
+    threads = [threading.Thread(target=worker) for i in xrange(concurrency)]
+    before = client.cache_stats()
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    r = report(recorder, time.time() - start)
+    after = client.cache_stats()
+    if after is not None:
+        hits = after['hits'] - before['hits']
+        lookups = hits + after['misses'] - before['misses']
+        r['render_cache'] = {'hits': hits,
+                             'lookups': lookups,
+                             'hit_rate': round(hits / float(lookups), 4) if lookups else 0.0,
+                             'bytes': after['bytes']}
+    return r
+
+def print_report(r, out=sys.stdout):
+    out.write('%d requests in %.2fs, %.1f req/s\n' % (r['requests'], r['elapsed_s'], r['rps']))
+    if 'render_cache' in r:
+        out.write('render cache: %(hits)d/%(lookups)d hits (%(hit_rate).3f), '
+                  '%(bytes)d bytes\n' % r['render_cache'])
+    out.write('%-24s %8s %8s %9s %9s %9s %7s %7s\n' % (
+                'endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                'errors', 'repeat'))
+    for name, e in sorted(r['endpoints'].items()):
+        out.write('%-24s %8d %8.1f %9.2f %9.2f %9.2f %7d %7.3f\n' % (
+                    name, e['requests'], e['rps'], e['p50_ms'], e['p95_ms'],
+                    e['p99_ms'], e['errors'], e['repeat_rate']))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Session-replay load test for web_raven')
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--ids', type=int, default=50,
+                        help='number of distinct matrices sessions revisit')
+    parser.add_argument('--skew', type=float, default=1.1,
+                        help='zipf exponent of matrix popularity')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--url', help='drive a running server instead of in-process')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args(argv)
+
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        import numpy
+        numpy.random.seed(args.seed)
+        client = WsgiClient(wsgi_app())
+    r = run(client, args.sessions, args.concurrency, args.ids, args.skew, args.seed)
+    print_report(r)
+    if args.json:
+        with open(args.json, 'w') as f:
+            simplejson.dump(r, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Fills web_raven's render cache before traffic asks for it.
+
+Keys are ('matrix', id) or ('figure', id), taken either from an access log
+sample, most requested first, or by enumerating every figure and matrix in
+the world. Warming runs in a background thread through the same render
+path the handlers use, and stops at a time or byte budget.
+"""
+import re
+import time
+import urllib
+import itertools
+import threading
+
+from raven import world
+from web_raven import figure_id, id_from_data
+
+url_pattern = re.compile(r'/(matrix_guess|figure_image)/([^\s?"]+)')
+url_kinds = {'matrix_guess': 'matrix', 'figure_image': 'figure'}
+
+def keys_from_access_log(lines):
+    """Cache keys requested in an access log, most requested first."""
+    counts = {}
+    for line in lines:
+        for kind, id in url_pattern.findall(line):
+            key = (url_kinds[kind], urllib.unquote(id))
+            counts[key] = counts.get(key, 0) + 1
+    return sorted(counts, key=lambda k: (-counts[k], k))
+
+def world_figures(world=world):
+    """Every figure, with every feature choice, that the world suggests."""
+    all_figures, all_feature_sets, all_features = world
+    for figure in all_figures:
+        for feature_sets in figure.suggested_feature_sets(all_feature_sets):
+            suggestions = [fs.suggested_features(all_features) for fs in feature_sets]
+            for features in itertools.product(*suggestions):
+                yield figure(feature_sets, list(features))
+
+def configurations(f):
+    return [list(c) for c in
+                itertools.product(*[range(len(fs)) for fs in f.features])]
+
+def keys_from_world(world=world):
+    """Every figure key, then every matrix key, generated lazily."""
+    for f in world_figures(world):
+        for c in configurations(f):
+            yield ('figure', figure_id(f, c))
+    all_figures, all_feature_sets, all_features = world
+    for f in world_figures(world):
+        cs = configurations(f)
+        for c, t1, t2 in itertools.product(cs, cs, cs):
+            data = {'fg': all_figures.index(f.__class__),
+                    'fs': [all_feature_sets.index(fs) for fs in f.feature_sets],
+                    'f': [[all_features.index(i) for i in fs] for fs in f.features],
+                    'c': c,
+                    't1': t1,
+                    't2': t2}
+            yield ('matrix', id_from_data(data))
+
+def keys_from_source(source):
+    """Keys for 'world', an access log path, or an iterable of keys."""
+    if not isinstance(source, basestring):
+        return source
+    if source == 'world':
+        return keys_from_world()
+    with open(source) as f:
+        return keys_from_access_log(f)
+
+def prewarm(keys, cache, render_functions, seconds=60, max_bytes=None):
+    """Renders keys into the cache until done or out of time or bytes.
+
+    cache and render_functions must be the serving module's own, e.g.
+    web_raven.render_cache and web_raven.render_functions.
+    """
+    if max_bytes is None:
+        max_bytes = cache.max_bytes
+    report = {'warmed': 0, 'bytes': 0, 'failed': 0, 'skipped': 0,
+              'stopped': 'done'}
+    start = time.time()
+    for key in keys:
+        if time.time() - start >= seconds:
+            report['stopped'] = 'time'
+            break
+        if report['bytes'] >= max_bytes:
+            report['stopped'] = 'bytes'
+            break
+        if key in cache:
+            report['skipped'] += 1
+            continue
+        try:
+            png = render_functions[key[0]](key[1])
+        except Exception:
+            report['failed'] += 1
+            continue
+        cache.put(key, png)
+        report['warmed'] += 1
+        report['bytes'] += len(png)
+    report['seconds'] = round(time.time() - start, 3)
+    return report
+
+def start_prewarm(source, cache, render_functions, **kwargs):
+    """Prewarms in a daemon thread and prints the report when it ends.
+
+    Keys are loaded from source inside the thread too, so reading a large
+    access log does not hold up the server.
+    """
+    def run():
+        keys = keys_from_source(source)
+        report = prewarm(keys, cache, render_functions, **kwargs)
+        print 'Prewarmed %(warmed)d pngs, %(bytes)d bytes in %(seconds)ss ' \
+              '(%(failed)d failed, %(skipped)d already cached, ' \
+              'stopped: %(stopped)s)' % report
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
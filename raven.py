@@ -3,6 +3,7 @@ import math
 import StringIO
 import itertools
 import abc
+import threading
 from contextlib import contextmanager
 
 import numpy
@@ -15,6 +16,57 @@ def create_cairo_surface(width, height, color=cairo.FORMAT_ARGB32):
     cr = cairo.Context(s)
     return s, cr
 
+class SurfacePool(threading.local):
+    """Per-thread pool of cairo surfaces keyed by (format, width, height).
+
+    Surfaces are handed out cleared, with a fresh drawing state, and go
+    back into the pool once the caller is done encoding them.
+    """
+    max_idle = 8
+
+    def __init__(self):
+        self.idle = {}
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, width, height, color=cairo.FORMAT_ARGB32):
+        idle = self.idle.get((color, width, height))
+        if idle:
+            s, cr = idle.pop()
+            self.reused += 1
+        else:
+            s, cr = create_cairo_surface(width, height, color)
+            self.created += 1
+        cr.save()
+        return s, cr
+
+    def release(self, s, cr):
+        key = (s.get_format(), s.get_width(), s.get_height())
+        idle = self.idle.setdefault(key, [])
+        if len(idle) >= self.max_idle:
+            return
+        cr.restore()
+        cr.new_path()
+        cr.save()
+        cr.set_operator(cairo.OPERATOR_CLEAR)
+        cr.paint()
+        cr.restore()
+        idle.append((s, cr))
+
+    def stats(self):
+        return {'size': sum(len(i) for i in self.idle.values()),
+                'created': self.created,
+                'reused': self.reused}
+
+surface_pool = SurfacePool()
+
+@contextmanager
+def pooled_cairo_surface(width, height, color=cairo.FORMAT_ARGB32):
+    s, cr = surface_pool.acquire(width, height, color)
+    yield s, cr
+    # a surface whose drawing raised may have unbalanced saves; let it go
+    surface_pool.release(s, cr)
+
 class Feature(object):
     __metaclass__ = abc.ABCMeta
 
@@ -291,21 +343,33 @@ class FeatureFigure(Figure):
         num_feature_sets = len(self.feature_sets)
         assert len(self.features) == num_feature_sets == len(configuration)
 
-def surface_to_png(surface):
-    buffer = StringIO.StringIO()
-    surface.write_to_png(buffer)
-    png = buffer.getvalue()
-    buffer.close()
-    return png
+class PngWriter(object):
+    """File-like object that hands each chunk cairo encodes to write()."""
+    def __init__(self, write):
+        self.write = write
+
+def surface_to_png(surface, write=None):
+    """Encodes surface as a png.
+
+    With write given, each chunk cairo encodes is handed to it and nothing
+    is returned; otherwise the chunks are joined once and returned.
+    """
+    if write is not None:
+        surface.write_to_png(PngWriter(write))
+        return
+    chunks = []
+    surface.write_to_png(PngWriter(chunks.append))
+    return ''.join(chunks)
 
 class CairoFigure(Figure):
-    def create_context(self, width, height, color=cairo.FORMAT_ARGB32):
-        s, cr = create_cairo_surface(width, height, color)
-        cr.scale(width/1.0, height/1.0)
-        return s, cr
+    @contextmanager
+    def pooled_context(self, width, height, color=cairo.FORMAT_ARGB32):
+        with pooled_cairo_surface(width, height, color) as (s, cr):
+            cr.scale(width/1.0, height/1.0)
+            yield s, cr
 
-    def surface_to_png(self, surface):
-        return surface_to_png(surface)
+    def surface_to_png(self, surface, write=None):
+        return surface_to_png(surface, write)
 
 class OneSimpleFigure(FeatureFigure, CairoFigure):
     def __init__(self, feature_sets, features):
@@ -313,12 +377,12 @@ class OneSimpleFigure(FeatureFigure, CairoFigure):
         assert(issubclass(feature_sets[0], DrawableFeatureSet))
         FeatureFigure.__init__(self, feature_sets, features)
         
-    def render(self, configuration):
+    def render(self, configuration, write=None):
         FeatureFigure.render(self, configuration)
-        surface, cr = self.create_context(figure_size, figure_size)
-        drawable = self.features[0][configuration[0]]()
-        drawable.draw(cr)
-        return self.surface_to_png(surface)
+        with self.pooled_context(figure_size, figure_size) as (surface, cr):
+            drawable = self.features[0][configuration[0]]()
+            drawable.draw(cr)
+            return self.surface_to_png(surface, write)
 
     @classmethod
     def suggested_feature_sets(cls, all_feature_sets):
@@ -332,14 +396,14 @@ class ColoredLinedShapeFigure(FeatureFigure, CairoFigure):
         assert(issubclass(feature_sets[2], SmallPositiveIntegerFeatureSet))
         FeatureFigure.__init__(self, feature_sets, features)
         
-    def render(self, configuration):
+    def render(self, configuration, write=None):
         FeatureFigure.render(self, configuration)
-        surface, cr = self.create_context(figure_size, figure_size)
-        shape = self.features[0][configuration[0]]
-        color = self.features[1][configuration[1]].value
-        w = self.features[2][configuration[2]].value
-        shape(color=color, line_width=(w,w)).draw(cr)
-        return self.surface_to_png(surface)
+        with self.pooled_context(figure_size, figure_size) as (surface, cr):
+            shape = self.features[0][configuration[0]]
+            color = self.features[1][configuration[1]].value
+            w = self.features[2][configuration[2]].value
+            shape(color=color, line_width=(w,w)).draw(cr)
+            return self.surface_to_png(surface, write)
 
     @classmethod
     def suggested_feature_sets(cls, all_feature_sets):
@@ -355,14 +419,14 @@ class RotatedShapeFigure(FeatureFigure, CairoFigure):
         assert(issubclass(feature_sets[1], RotationAngleFeatureSet))
         FeatureFigure.__init__(self, feature_sets, features)
         
-    def render(self, configuration):
+    def render(self, configuration, write=None):
         FeatureFigure.render(self, configuration)
-        surface, cr = self.create_context(figure_size, figure_size)
-        shape = self.features[0][configuration[0]]
-        angle = self.features[1][configuration[1]].value
-        transformation = transformation_matrix(angle=angle)
-        shape(transformation=transformation).draw(cr)
-        return self.surface_to_png(surface)
+        with self.pooled_context(figure_size, figure_size) as (surface, cr):
+            shape = self.features[0][configuration[0]]
+            angle = self.features[1][configuration[1]].value
+            transformation = transformation_matrix(angle=angle)
+            shape(transformation=transformation).draw(cr)
+            return self.surface_to_png(surface, write)
 
     @classmethod
     def suggested_feature_sets(cls, all_feature_sets):
@@ -379,18 +443,14 @@ def rotated_transformation_matrix(a, x=0, y=0):
         [-numpy.sin(a), numpy.cos(a), x - x * numpy.sin(a) + y * numpy.cos(a)],
         [0, 0, 1]])
 
-def rpm_from_pngs(pngs):
+def rpm_from_pngs(pngs, write=None):
     width, height = figure_size * 3, figure_size * 3
-    rpm, cr = create_cairo_surface(width, height)
-    for x,y,png in zip([0, figure_size, figure_size*2] * 3, [0] * 3 + [figure_size] * 3 + [figure_size*2] * 3, pngs):
-        figure = cairo.ImageSurface.create_from_png(StringIO.StringIO(png))
-        cr.set_source_surface(figure, x, y)
-        cr.paint()
-    buffer = StringIO.StringIO()
-    rpm.write_to_png(buffer)
-    png = buffer.getvalue()
-    buffer.close()
-    return png
+    with pooled_cairo_surface(width, height) as (rpm, cr):
+        for x,y,png in zip([0, figure_size, figure_size*2] * 3, [0] * 3 + [figure_size] * 3 + [figure_size*2] * 3, pngs):
+            figure = cairo.ImageSurface.create_from_png(StringIO.StringIO(png))
+            cr.set_source_surface(figure, x, y)
+            cr.paint()
+        return surface_to_png(rpm, write)
 
 def rpm_from_cmatrix(f, cmatrix):
     pngs = [f.render(c) for c in itertools.chain(*cmatrix)]
@@ -424,13 +484,18 @@ def cmatrix_from_two_transitions(figure, configuration, transition1, transition2
     return cmatrix
     
 def create_blank_png(width, height):
-    s, cr = create_cairo_surface(width, height)
-    return surface_to_png(s)
+    with pooled_cairo_surface(width, height) as (s, cr):
+        return surface_to_png(s)
+
+def rpm_guess_pngs(figure, cmatrix):
+    cells = [c for c in itertools.chain(*cmatrix)][:8]
+    pngs = [figure.render(c) for c in cells]
+    pngs.append(create_blank_png(figure_size, figure_size))
+    return pngs
 
 def rpm_images(figure, cmatrix, choices):
-    pngs = [figure.render(c) for c in itertools.chain(*cmatrix)]
-    blank_png = create_blank_png(figure_size, figure_size)
-    answer, pngs[8] = pngs[8], blank_png
+    pngs = rpm_guess_pngs(figure, cmatrix)
+    answer = figure.render(cmatrix[2][2])
     rpm = rpm_from_pngs(pngs)
     choice_images = [figure.render(c) for c in choices]
     return rpm, answer, choice_images
@@ -454,8 +519,43 @@ def generate_choices(f, c, t1, t2, answer):
     if str(answer) in choices:
         del(choices[str(answer)])
     return choices.values()
+
+def other_configurations(f, answer):
+    """Every configuration of f but answer.
+
+    Fallback distractors for when generate_choices comes back empty,
+    which happens when every transition is zero.
+    """
+    everything = itertools.product(*[range(len(fs)) for fs in f.features])
+    return [[i for i in c] for c in everything if [i for i in c] != answer]
         
 
+all_figures = [OneSimpleFigure, 
+               ColoredLinedShapeFigure,
+              ]
+all_feature_sets = [TripleShapeFeatureSet,
+                    TripleColorFeatureSet,
+                    TripleSmallPositiveIntegerFeatureSet,
+                   ]
+all_features = [Triangle, Square, Circle,
+                Blue, Red, Green, Yellow, Magenta, Cyan,
+                V1, V2, V4, V8, V16,
+               ]
+world = (all_figures, all_feature_sets, all_features)
+
+def random_element(array):
+    return array[numpy.random.randint(0, len(array))]
+
+def random_matrix(all_figures, all_feature_sets, all_features):
+    figure = random_element(all_figures)
+    feature_sets = random_element(figure.suggested_feature_sets(all_feature_sets))
+    features = [random_element(fs.suggested_features(all_features)) for fs in feature_sets]
+    f = figure(feature_sets, features)
+    c = [numpy.random.randint(0, 3) for a in features]
+    t1 = [numpy.random.randint(0, 3) for a in features]
+    t2 = [numpy.random.randint(0, 3) for a in features]
+    return {'fg': figure, 'c': c, 't1': t1, 't2': t2, 'fs': feature_sets, 'f': features}
+
 
 if __name__ == '__main__':
     f = OneSimpleFigure([TripleShapeFeatureSet,], 
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""Serving mode that keeps rendering off the request threads.
+
+Every connection gets its own thread, up to a fixed limit, so cheap pages
+like index and list are answered straight away. Requests that render
+images are handed to a RenderPool: a fixed number of worker threads fed by
+a bounded queue. When the connection limit or the queue is full, or a
+render takes too long, the request is shed with a 503 instead of waiting.
+"""
+import sys
+import Queue
+import socket
+import threading
+import SocketServer
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+render_prefixes = ('/matrix_guess/', '/figure_image/', '/batch_ask_matrix', '/debug')
+
+class Saturated(Exception):
+    pass
+
+class RenderJob(object):
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.started = False
+        self.cancelled = False
+        self.result = None
+        self.exc_info = None
+
+    def run(self):
+        """Runs the job unless it was cancelled first; says whether it ran."""
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.started = True
+        try:
+            self.result = self.fn(*self.args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+        return True
+
+    def cancel(self):
+        """Stops the job from running if no worker has picked it up yet."""
+        with self.lock:
+            if not self.started:
+                self.cancelled = True
+            return self.cancelled
+
+    def wait(self, timeout=None):
+        """Returns the result, or cancels and raises Saturated on timeout."""
+        if not self.done.wait(timeout):
+            self.cancel()
+            raise Saturated()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+class RenderPool(object):
+    """Fixed set of worker threads with a bounded queue in front."""
+    def __init__(self, workers=4, backlog=16):
+        assert(workers > 0 and backlog > 0)
+        self.queue = Queue.Queue(maxsize=backlog)
+        self.lock = threading.Lock()
+        self.counts = {'accepted': 0, 'rejected': 0, 'cancelled': 0}
+        self.threads = [threading.Thread(target=self.work) for i in xrange(workers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if not job.run():
+                with self.lock:
+                    self.counts['cancelled'] += 1
+            self.queue.task_done()
+
+    def submit(self, fn, *args):
+        job = RenderJob(fn, args)
+        try:
+            self.queue.put_nowait(job)
+        except Queue.Full:
+            with self.lock:
+                self.counts['rejected'] += 1
+            raise Saturated()
+        with self.lock:
+            self.counts['accepted'] += 1
+        return job
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+def call_app(app, environ):
+    """Runs a wsgi app to completion, returning status, headers and body."""
+    response = {}
+    chunks = []
+    def start_response(status, headers, exc_info=None):
+        response['status'], response['headers'] = status, headers
+        return chunks.append
+    result = app(environ, start_response)
+    try:
+        for chunk in result:
+            chunks.append(chunk)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], chunks
+
+class RenderOffloadMiddleware(object):
+    """Sends rendering requests through a RenderPool, 503 when it is full."""
+    def __init__(self, app, pool, prefixes=render_prefixes, retry_after=1,
+                 timeout=30, bypass=None):
+        self.app = app
+        self.pool = pool
+        self.prefixes = prefixes
+        self.retry_after = retry_after
+        self.timeout = timeout
+        # bypass(environ) says a request is cheap after all, e.g. cached
+        self.bypass = bypass
+
+    def __call__(self, environ, start_response):
+        if not environ.get('PATH_INFO', '').startswith(self.prefixes):
+            return self.app(environ, start_response)
+        if self.bypass is not None and self.bypass(environ):
+            return self.app(environ, start_response)
+        try:
+            job = self.pool.submit(call_app, self.app, environ)
+            status, headers, chunks = job.wait(self.timeout)
+        except Saturated:
+            start_response('503 Service Unavailable',
+                           [('Content-Type', 'text/plain'),
+                            ('Retry-After', str(self.retry_after))])
+            return ['Busy rendering, try again shortly.\n']
+        start_response(status, headers)
+        return chunks
+
+busy_response = ('HTTP/1.0 503 Service Unavailable\r\n'
+                 'Content-Type: text/plain\r\n'
+                 'Retry-After: 1\r\n'
+                 'Connection: close\r\n\r\n'
+                 'Too many connections, try again shortly.\n')
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    """Thread per connection, answering 503 past max_connections."""
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, max_connections=64):
+        WSGIServer.__init__(self, server_address, handler_class)
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(False):
+            try:
+                request.sendall(busy_response)
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.slots.release()
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def make_server(app, host='0.0.0.0', port=8087, workers=4, backlog=16,
+                max_connections=64, timeout=30, bypass=None, quiet=False):
+    pool = RenderPool(workers, backlog)
+    handler = QuietHandler if quiet else WSGIRequestHandler
+    httpd = ThreadingWSGIServer((host, port), handler, max_connections)
+    httpd.set_app(RenderOffloadMiddleware(app, pool, timeout=timeout,
+                                          bypass=bypass))
+    return httpd
+
+def serve(app, host='0.0.0.0', port=8087, **kwargs):
+    make_server(app, host, port, **kwargs).serve_forever()
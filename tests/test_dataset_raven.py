@@ -0,0 +1,48 @@
+import shutil
+import tempfile
+
+import numpy
+
+import dataset_raven
+
+def test_build_and_read():
+    path = tempfile.mkdtemp()
+    try:
+        dataset_raven.build_dataset(path, 5, k=4, seed=3, chunk_size=2)
+        spec, arrays = dataset_raven.open_dataset(path)
+        h, w = spec['height'], spec['width']
+        assert arrays['context'].shape == (5, 9, h, w)
+        assert arrays['choices'].shape == (5, 4, h, w)
+        assert arrays['answers'].shape == (5,)
+        assert (arrays['answers'] < 4).all()
+        # the ninth cell is left blank, i.e. white
+        assert (arrays['context'][:, 8] == 255).all()
+        assert (arrays['context'][:, 0] < 255).any()
+        for i in xrange(5):
+            context, choices, answer = dataset_raven.puzzle_pngs(3 + i, 4)
+            assert answer == arrays['answers'][i]
+            assert (dataset_raven.gray_from_png(choices[answer]) ==
+                    arrays['choices'][i, answer]).all()
+    finally:
+        shutil.rmtree(path)
+
+def test_fill_disjoint_ranges():
+    path = tempfile.mkdtemp()
+    try:
+        dataset_raven.create_dataset(path, 4, k=3)
+        dataset_raven.fill_dataset(path, 2, 4, seed=7)
+        spec, arrays = dataset_raven.open_dataset(path)
+        assert (arrays['context'][:2] == 0).all()
+        first = numpy.array(arrays['context'][2:])
+        dataset_raven.fill_dataset(path, 0, 2, seed=7)
+        assert (arrays['context'][2:] == first).all()
+        assert (arrays['context'][:2, 8] == 255).all()
+    finally:
+        shutil.rmtree(path)
+
+def test_pick_distractors():
+    picked = dataset_raven.pick_distractors(['a', 'b'], 5)
+    assert len(picked) == 5
+    assert set(picked) == set(['a', 'b'])
+    picked = dataset_raven.pick_distractors(['a', 'b', 'c', 'd'], 3)
+    assert len(set(picked)) == 3
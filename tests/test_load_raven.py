@@ -0,0 +1,39 @@
+import random
+import load_raven
+
+def test_percentile():
+    ordered = range(1, 101)
+    assert load_raven.percentile(ordered, 50) == 50
+    assert load_raven.percentile(ordered, 99) == 99
+    assert load_raven.percentile([7], 95) == 7
+
+def test_catalogue_skew():
+    catalogue = load_raven.Catalogue(3, 2.0)
+    rng = random.Random(0)
+    assert [catalogue.pick(p, rng) for p in 'abc'] == ['a', 'b', 'c']
+    picks = [catalogue.pick('fresh', rng) for i in xrange(1000)]
+    assert 'fresh' not in picks
+    assert picks.count('a') > picks.count('b') > picks.count('c')
+
+def test_run_in_process():
+    client = load_raven.WsgiClient(load_raven.wsgi_app())
+    r = load_raven.run(client, sessions=3, concurrency=2, ids=2, skew=1.0, seed=0)
+    endpoints = r['endpoints']
+    assert endpoints['generate_random_matrix']['requests'] == 3
+    assert endpoints['ask_matrix']['requests'] >= 3
+    assert endpoints['figure_image']['requests'] > 0
+    assert endpoints['matrix_guess']['requests'] == 3
+    assert sum(e['errors'] for e in endpoints.values()) == 0
+
+class FailingClient(object):
+    def request(self, method, path, body=None):
+        raise IOError('connection refused')
+
+    def cache_stats(self):
+        return None
+
+def test_failed_requests_are_counted():
+    r = load_raven.run(FailingClient(), sessions=5, concurrency=2, ids=2, skew=1.0, seed=0)
+    e = r['endpoints']['generate_random_matrix']
+    assert e['requests'] == 5
+    assert e['errors'] == 5
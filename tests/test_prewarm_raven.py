@@ -0,0 +1,57 @@
+import os
+import tempfile
+import itertools
+
+import web_raven
+import prewarm_raven
+
+def test_keys_from_access_log():
+    lines = ['GET /figure_image/abc HTTP/1.1',
+             'GET /matrix_guess/xyz HTTP/1.1',
+             'GET /figure_image/abc HTTP/1.1',
+             'GET /list HTTP/1.1',
+            ]
+    assert prewarm_raven.keys_from_access_log(lines) == [('figure', 'abc'),
+                                                         ('matrix', 'xyz')]
+
+def test_keys_from_world():
+    keys = list(itertools.islice(prewarm_raven.keys_from_world(), 3))
+    assert [k for k,id in keys] == ['figure'] * 3
+    f, c = web_raven.figure_from_id(keys[0][1])
+    assert len(f.render(c)) > 0
+
+def test_prewarm():
+    cache = web_raven.RenderCache()
+    keys = list(itertools.islice(prewarm_raven.keys_from_world(), 4))
+    keys.append(('matrix', web_raven.id_from_data({'fg':0,'fs':[0],'f':[[0,1,2]],
+                                                     'c':[2],'t1':[1],'t2':[2]})))
+    render = web_raven.render_functions
+    report = prewarm_raven.prewarm(keys, cache, render)
+    assert report['warmed'] == 5
+    assert report['stopped'] == 'done'
+    assert cache.stats()['bytes'] == report['bytes']
+    for key in keys:
+        assert cache.get(key) is not None
+    assert prewarm_raven.prewarm(keys, cache, render)['skipped'] == 5
+    assert prewarm_raven.prewarm(keys, cache, render, seconds=0)['stopped'] == 'time'
+
+def test_start_prewarm_fills_given_cache():
+    key = list(itertools.islice(prewarm_raven.keys_from_world(), 1))[0]
+    cache = web_raven.RenderCache()
+    thread = prewarm_raven.start_prewarm([key], cache, web_raven.render_functions)
+    thread.join(30)
+    assert key in cache
+    assert key not in web_raven.render_cache
+
+def test_start_prewarm_reads_log_in_background():
+    path = tempfile.mktemp()
+    key = list(itertools.islice(prewarm_raven.keys_from_world(), 1))[0]
+    with open(path, 'w') as f:
+        f.write('GET /figure_image/%s HTTP/1.1\n' % key[1])
+    try:
+        cache = web_raven.RenderCache()
+        thread = prewarm_raven.start_prewarm(path, cache, web_raven.render_functions)
+        thread.join(30)
+        assert key in cache
+    finally:
+        os.remove(path)
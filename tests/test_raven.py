@@ -20,3 +20,35 @@ def test_transform():
     assert [0,] == f.transform([2], [1,])
     assert [1,] == f.transform([2], [2,])
 
+
+def test_surface_pool_reuse():
+    pool = SurfacePool()
+    s, cr = pool.acquire(10, 10)
+    cr.set_source_rgba(1, 0, 0, 1)
+    cr.paint()
+    pool.release(s, cr)
+    assert pool.stats() == {'size': 1, 'created': 1, 'reused': 0}
+    s2, cr2 = pool.acquire(10, 10)
+    assert s2 is s
+    assert not str(s2.get_data()).strip('\x00')
+    assert pool.stats() == {'size': 0, 'created': 1, 'reused': 1}
+    pool.release(s2, cr2)
+    s3, cr3 = pool.acquire(20, 10)
+    assert s3 is not s
+    assert pool.stats()['created'] == 2
+
+def test_pooled_render_matches():
+    f = OneSimpleFigure([TripleShapeFeatureSet,], [[Triangle, Square, Circle],])
+    pngs = [f.render([i,]) for i in [0, 1, 2, 0, 1, 2]]
+    assert pngs[:3] == pngs[3:]
+
+def test_render_streams_png():
+    f = OneSimpleFigure([TripleShapeFeatureSet,], [[Triangle, Square, Circle],])
+    chunks = []
+    assert f.render([1,], chunks.append) is None
+    assert len(chunks) > 0
+    assert ''.join(chunks) == f.render([1,])
+
+def test_other_configurations():
+    f = OneSimpleFigure([TripleShapeFeatureSet,], [[Triangle, Square, Circle],])
+    assert other_configurations(f, [1,]) == [[0,], [2,]]
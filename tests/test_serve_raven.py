@@ -0,0 +1,129 @@
+import time
+import socket
+import threading
+from wsgiref.util import setup_testing_defaults
+
+import serve_raven
+
+def environ(path):
+    e = {'PATH_INFO': path}
+    setup_testing_defaults(e)
+    return e
+
+def call(app, path):
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+    body = ''.join(app(environ(path), start_response))
+    return response['status'], body
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+def gated_app(gate, started):
+    def app(environ, start_response):
+        if environ['PATH_INFO'].startswith('/figure_image/'):
+            started.release()
+            gate.wait()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO']]
+    return app
+
+def test_offloads_renders():
+    gate, started = threading.Event(), threading.Semaphore(0)
+    gate.set()
+    pool = serve_raven.RenderPool(workers=1, backlog=1)
+    app = serve_raven.RenderOffloadMiddleware(gated_app(gate, started), pool)
+    assert call(app, '/figure_image/abc') == ('200 OK', '/figure_image/abc')
+    assert call(app, '/list') == ('200 OK', '/list')
+    assert pool.stats() == {'accepted': 1, 'rejected': 0, 'cancelled': 0,
+                            'queued': 0}
+
+def test_sheds_when_saturated():
+    gate, started = threading.Event(), threading.Semaphore(0)
+    pool = serve_raven.RenderPool(workers=1, backlog=1)
+    app = serve_raven.RenderOffloadMiddleware(gated_app(gate, started), pool)
+    results = []
+    first = threading.Thread(target=lambda: results.append(call(app, '/figure_image/1')))
+    first.start()
+    started.acquire()
+    # the worker is busy, so this one waits in the queue
+    second = threading.Thread(target=lambda: results.append(call(app, '/figure_image/2')))
+    second.start()
+    wait_until(lambda: pool.stats()['queued'] >= 1)
+    status, body = call(app, '/figure_image/3')
+    assert status == '503 Service Unavailable'
+    # cheap requests are not held up by the busy pool
+    assert call(app, '/list') == ('200 OK', '/list')
+    gate.set()
+    first.join()
+    second.join()
+    assert sorted(results) == [('200 OK', '/figure_image/1'),
+                               ('200 OK', '/figure_image/2')]
+    assert pool.stats()['rejected'] == 1
+
+def test_slow_render_times_out():
+    gate, started = threading.Event(), threading.Semaphore(0)
+    pool = serve_raven.RenderPool(workers=1, backlog=1)
+    app = serve_raven.RenderOffloadMiddleware(gated_app(gate, started), pool,
+                                              timeout=0.05)
+    status, body = call(app, '/figure_image/slow')
+    assert status == '503 Service Unavailable'
+    gate.set()
+
+def test_sheds_past_max_connections():
+    gate, started = threading.Event(), threading.Semaphore(0)
+    httpd = serve_raven.make_server(gated_app(gate, started), '127.0.0.1', 0,
+                                    max_connections=1, quiet=True)
+    server = threading.Thread(target=httpd.serve_forever)
+    server.daemon = True
+    server.start()
+    port = httpd.server_address[1]
+    try:
+        first = socket.create_connection(('127.0.0.1', port))
+        first.sendall('GET /figure_image/1 HTTP/1.0\r\n\r\n')
+        started.acquire()
+        second = socket.create_connection(('127.0.0.1', port))
+        second.sendall('GET /list HTTP/1.0\r\n\r\n')
+        assert second.makefile().readline().startswith('HTTP/1.0 503')
+        gate.set()
+        assert ' 200 ' in first.makefile().readline()
+    finally:
+        gate.set()
+        httpd.shutdown()
+        httpd.server_close()
+
+def test_timed_out_queued_job_never_runs():
+    gate, started = threading.Event(), threading.Semaphore(0)
+    ran = []
+    inner = gated_app(gate, started)
+    def recording(environ, start_response):
+        ran.append(environ['PATH_INFO'])
+        return inner(environ, start_response)
+    pool = serve_raven.RenderPool(workers=1, backlog=1)
+    app = serve_raven.RenderOffloadMiddleware(recording, pool, timeout=0.05)
+    first = threading.Thread(target=lambda: call(app, '/figure_image/1'))
+    first.start()
+    started.acquire()
+    # the worker is busy, so this one sits in the queue until it times out
+    status, body = call(app, '/figure_image/2')
+    assert status == '503 Service Unavailable'
+    gate.set()
+    first.join()
+    wait_until(lambda: pool.stats()['cancelled'] == 1)
+    assert ran == ['/figure_image/1']
+
+def test_bypass_skips_the_pool():
+    gate, started = threading.Event(), threading.Semaphore(0)
+    gate.set()
+    pool = serve_raven.RenderPool(workers=1, backlog=1)
+    app = serve_raven.RenderOffloadMiddleware(
+                gated_app(gate, started), pool,
+                bypass=lambda environ: environ['PATH_INFO'].endswith('cached'))
+    assert call(app, '/figure_image/cached') == ('200 OK', '/figure_image/cached')
+    assert pool.stats()['accepted'] == 0
+    assert call(app, '/figure_image/cold') == ('200 OK', '/figure_image/cold')
+    assert pool.stats()['accepted'] == 1
@@ -58,3 +58,85 @@ def test_generate_random_matrix():
         #TODO: jperla: check the redirect
         body = r.body
     
+
+def test_batch_ask_matrix():
+    with get(app, '/batch_ask_matrix?k=3') as r:
+        assert(r.status == '200 OK')
+        puzzles = web_raven.simplejson.loads(r.body)['puzzles']
+    assert(len(puzzles) == 3)
+    secret = web_raven.default_answer_secret
+    for puzzle in puzzles:
+        assert(len(puzzle['grid']) > 15)
+        assert(len(puzzle['choices']) > 1)
+        submissions = [{'id': puzzle['id'], 'figure': c['id']}
+                            for c in puzzle['choices']]
+        graded = web_raven.grade_submissions(secret, submissions)
+        assert(len([g for g in graded if g['correct']]) == 1)
+        for s in submissions:
+            s['token'] = puzzle['token']
+        assert(graded == web_raven.grade_submissions(secret, submissions))
+
+def test_grade_submissions_bad_input():
+    secret = web_raven.default_answer_secret
+    id = web_raven.id_from_data({'fg':0,'fs':[0],'f':[[0,1,2]],
+                                 'c':[2],'t1':[1],'t2':[2]})
+    f, c, t1, t2 = web_raven.matrix_from_id(id)
+    cmatrix = web_raven.cmatrix_from_two_transitions(f, c, t1, t2)
+    answer = web_raven.figure_id(f, cmatrix[2][2])
+    graded = web_raven.grade_submissions(secret, [
+                {'id': id, 'figure': answer, 'token': 'signed-elsewhere'},
+                {'id': id},
+                'nonsense',
+                {'id': '!!!', 'figure': answer},
+             ])
+    assert graded[0]['correct']
+    assert 'error' in graded[1] and 'error' in graded[2] and 'error' in graded[3]
+
+def test_batch_bad_request():
+    with get(app, '/batch_ask_matrix?k=many') as r:
+        assert(r.status == '400 Bad Request')
+    with get(app, '/batch_ask_matrix?k=%d' % (web_raven.max_batch_size + 1)) as r:
+        assert(r.status == '400 Bad Request')
+    with get(app, '/batch_ask_matrix?k=0') as r:
+        assert(r.status == '400 Bad Request')
+
+def call_streaming(streaming, path):
+    response = {'written': []}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        return response['written'].append
+    body = streaming({'REQUEST_METHOD': 'GET', 'PATH_INFO': path}, start_response)
+    return response['status'], response['written'], [b for b in body]
+
+def test_png_stream_middleware():
+    cache = web_raven.RenderCache()
+    streaming = web_raven.PngStreamMiddleware(app, cache)
+    id = web_raven.id_from_data({'fg':0,'fs':[0],'f':[[0,1,2]],
+                                 'c':[2],'t1':[1],'t2':[2]})
+    status, written, body = call_streaming(streaming, '/matrix_guess/' + id)
+    assert status == '200 OK'
+    assert written and body == []
+    png = ''.join(written)
+    assert png.startswith('\x89PNG')
+    assert cache.get(('matrix', id)) == png
+    status, written, body = call_streaming(streaming, '/matrix_guess/' + id)
+    assert status == '200 OK'
+    assert written == [] and body == [png]
+
+def test_png_stream_middleware_falls_through():
+    def fallback(environ, start_response):
+        start_response('404 Not Found', [])
+        return ['fallback']
+    streaming = web_raven.PngStreamMiddleware(fallback, web_raven.RenderCache())
+    assert call_streaming(streaming, '/figure_image/!!!')[2] == ['fallback']
+    assert call_streaming(streaming, '/list')[2] == ['fallback']
+
+def test_render_cache_evicts_oldest():
+    cache = web_raven.RenderCache(max_bytes=10)
+    cache.put('a', '1234')
+    cache.put('b', '1234')
+    assert cache.get('a') == '1234'
+    cache.put('c', '1234')
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+    assert cache.stats() == {'entries': 2, 'bytes': 8, 'hits': 1, 'misses': 0}
@@ -1,5 +1,13 @@
 #!/usr/bin/env python
 import zlib
+import itertools
+import threading
+import collections
+import os
+import sys
+import argparse
+import hmac
+import hashlib
 import simplejson
 import base64
 
@@ -20,32 +28,10 @@ app = webify.defaults.app()
 def index(req, p):
     p(u'Hello, world!')
 
-all_figures = [OneSimpleFigure, 
-               ColoredLinedShapeFigure,
-              ]
-all_feature_sets = [TripleShapeFeatureSet,
-                    TripleColorFeatureSet,
-                    TripleSmallPositiveIntegerFeatureSet,
-                   ]
-all_features = [Triangle, Square, Circle,
-                Blue, Red, Green, Yellow, Magenta, Cyan,
-                V1, V2, V4, V8, V16,
-               ]
-world = (all_figures, all_feature_sets, all_features)
-
-def random_element(array):
-    return array[numpy.random.randint(0, len(array))]
-
-def random_matrix(all_figures, all_feature_sets, all_features):
-    figure = random_element(all_figures)
-    feature_sets = random_element(figure.suggested_feature_sets(all_feature_sets))
-    features = [random_element(fs.suggested_features(all_features)) for fs in feature_sets]
-    f = figure(feature_sets, features)
-    c = [numpy.random.randint(0, 3) for a in features]
-    t1 = [numpy.random.randint(0, 3) for a in features]
-    t2 = [numpy.random.randint(0, 3) for a in features]
-    return {'fg': figure, 'c': c, 't1': t1, 't2': t2, 'fs': feature_sets, 'f': features}
-    
+
+max_batch_size = 50
+default_answer_secret = base64.b64encode(os.urandom(16))
+
 
 @app.subapp()
 @webify.urlable()
@@ -162,28 +148,138 @@ def id_from_data(data):
 @app.subapp()
 @webargs.RemainingUrlableAppWrapper()
 def matrix_guess(req, p, id):
-    f, c, t1, t2 = matrix_from_id(id)
-    cmatrix = cmatrix_from_one_transition(f, c, t1)
-    cmatrix = cmatrix_from_two_transitions(f, c, t1, t2)
-    png,_,_ = rpm_images(f, cmatrix, [])
     #TODO: jperla: make this simpler
     k,v = webify.http.headers.content_types.image_png
     p.headers[k] = v
     p.encoding = None
-    p(png)
+    write_cached_png(p, ('matrix', id), render_matrix_png)
 
 
 @app.subapp()
 @webargs.RemainingUrlableAppWrapper()
 def figure_image(req, p, id):
-    f, c = figure_from_id(id)
-    png = f.render(c)
     #TODO: jperla: make this simpler
     k,v = webify.http.headers.content_types.image_png
     p.headers[k] = v
     p.encoding = None
+    write_cached_png(p, ('figure', id), render_figure_png)
+
+def render_matrix_png(id, write=None):
+    f, c, t1, t2 = matrix_from_id(id)
+    cmatrix = cmatrix_from_two_transitions(f, c, t1, t2)
+    return rpm_from_pngs(rpm_guess_pngs(f, cmatrix), write)
+
+def render_figure_png(id, write=None):
+    f, c = figure_from_id(id)
+    return f.render(c, write)
+
+render_functions = {'matrix': render_matrix_png, 'figure': render_figure_png}
+png_routes = [('/matrix_guess/', 'matrix'), ('/figure_image/', 'figure')]
+
+def png_key(path):
+    """The render cache key a png url maps to, or None."""
+    for prefix, kind in png_routes:
+        if path.startswith(prefix) and len(path) > len(prefix):
+            return (kind, path[len(prefix):])
+    return None
+
+def png_cached(environ):
+    """Whether the request is for a png already in render_cache."""
+    key = png_key(environ.get('PATH_INFO', ''))
+    return key is not None and key in render_cache
+
+class RenderCache(object):
+    """Thread-safe LRU of encoded pngs, bounded by their total size."""
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.pngs = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.pngs
+
+    def get(self, key):
+        with self.lock:
+            png = self.pngs.pop(key, None)
+            if png is None:
+                self.misses += 1
+                return None
+            self.pngs[key] = png
+            self.hits += 1
+            return png
+
+    def put(self, key, png):
+        if len(png) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.pngs.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            while self.size + len(png) > self.max_bytes:
+                _, evicted = self.pngs.popitem(last=False)
+                self.size -= len(evicted)
+            self.pngs[key] = png
+            self.size += len(png)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.pngs), 'bytes': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+render_cache = RenderCache()
+
+def write_cached_png(p, key, render):
+    """Writes the png for key to p, rendering and caching it on a miss."""
+    png = render_cache.get(key)
+    if png is None:
+        png = render(key[1])
+        render_cache.put(key, png)
     p(png)
 
+class PngStreamMiddleware(object):
+    """Serves matrix_guess and figure_image pngs in front of webify.
+
+    webify buffers whatever a handler writes until it returns. Here each
+    chunk cairo encodes goes straight to the server through the write
+    callable from start_response, and into the render cache too. An id
+    that fails before any byte is sent falls through to the webify
+    handlers, so errors look the same as before.
+    """
+    def __init__(self, app, cache, render_functions=render_functions):
+        self.app = app
+        self.cache = cache
+        self.render_functions = render_functions
+
+    def __call__(self, environ, start_response):
+        key = png_key(environ.get('PATH_INFO', ''))
+        if key is None or environ.get('REQUEST_METHOD', 'GET') != 'GET':
+            return self.app(environ, start_response)
+        png = self.cache.get(key)
+        if png is not None:
+            start_response('200 OK', [('Content-Type', 'image/png'),
+                                      ('Content-Length', str(len(png)))])
+            return [png]
+        chunks = []
+        response = {}
+        def write(chunk):
+            if 'write' not in response:
+                response['write'] = start_response('200 OK',
+                                                   [('Content-Type', 'image/png')])
+            chunks.append(chunk)
+            response['write'](chunk)
+        try:
+            self.render_functions[key[0]](key[1], write)
+        except Exception:
+            if 'write' in response:
+                raise
+            return self.app(environ, start_response)
+        self.cache.put(key, ''.join(chunks))
+        return []
+
 def figure_from_id(id):
     data = data_from_id(id)
     figure = all_figures[data['fg']]
@@ -205,6 +301,122 @@ def matrix_from_id(id):
     return f, c, t1, t2
 
 
+def answer_token(secret, matrix_id, answer_id):
+    return hmac.new(secret, matrix_id + ':' + answer_id, hashlib.sha1).hexdigest()
+
+def batch_puzzles(ids, secret):
+    """Builds the JSON-ready puzzles for many matrix ids at once.
+
+    Figure renders are shared across the whole batch, so a figure that
+    shows up in several grids or choice lists is only drawn once.
+    """
+    renders = {}
+    def render(f, c):
+        fid = figure_id(f, c)
+        if fid not in renders:
+            renders[fid] = f.render(c)
+        return fid
+    blank_png = create_blank_png(figure_size, figure_size)
+    puzzles = []
+    for id in ids:
+        f, c, t1, t2 = matrix_from_id(id)
+        cmatrix = cmatrix_from_two_transitions(f, c, t1, t2)
+        pngs = [renders[render(f, i)] for i in itertools.chain(*cmatrix)]
+        pngs[8] = blank_png
+        answer_id = render(f, cmatrix[2][2])
+        distractors = generate_choices(f, c, t1, t2, cmatrix[2][2])
+        if not distractors:
+            distractors = other_configurations(f, cmatrix[2][2])
+        choice_ids = [render(f, i) for i in distractors]
+        choice_ids.append(answer_id)
+        numpy.random.shuffle(choice_ids)
+        puzzles.append({'id': id,
+                        'grid': base64.b64encode(rpm_from_pngs(pngs)),
+                        'choices': [{'id': i, 'image': base64.b64encode(renders[i])}
+                                        for i in choice_ids],
+                        'token': answer_token(secret, id, answer_id)})
+    return puzzles
+
+def grade_submissions(secret, submissions):
+    """Grades a list of {'id', 'figure'[, 'token']} submissions.
+
+    A matching token from batch_ask_matrix proves the guess right without
+    any work. A token that does not match may just have been signed by
+    another process, so the answer is then recomputed from the matrix id,
+    as ask_matrix does. Malformed submissions get an 'error' entry
+    instead of failing the whole batch.
+    """
+    answers = {}
+    results = []
+    for s in submissions:
+        if not isinstance(s, dict) or not isinstance(s.get('id'), basestring) \
+                or not isinstance(s.get('figure'), basestring):
+            results.append({'error': 'submission needs string id and figure'})
+            continue
+        id, guessed = s['id'], s['figure']
+        token = s.get('token')
+        if isinstance(token, basestring) and hmac.compare_digest(
+                    token.encode('utf-8'),
+                    answer_token(secret, id.encode('utf-8'), guessed.encode('utf-8'))):
+            correct = True
+        else:
+            if id not in answers:
+                try:
+                    f, c, t1, t2 = matrix_from_id(id)
+                    cmatrix = cmatrix_from_two_transitions(f, c, t1, t2)
+                    answers[id] = figure_id(f, cmatrix[2][2])
+                except Exception:
+                    answers[id] = None
+            if answers[id] is None:
+                results.append({'id': id, 'figure': guessed,
+                                'error': 'invalid matrix id'})
+                continue
+            correct = (answers[id] == guessed)
+        results.append({'id': id, 'figure': guessed, 'correct': correct})
+    return results
+
+def json_response(p, data):
+    p.headers['Content-Type'] = 'application/json'
+    p.encoding = None
+    p(simplejson.dumps(data))
+
+def json_bad_request(p, message):
+    p.status = '400 Bad Request'
+    json_response(p, {'error': message})
+
+@app.subapp()
+@webify.urlable()
+def batch_ask_matrix(req, p):
+    pool = req.settings['fff']
+    secret = req.settings.get('answer_secret', default_answer_secret)
+    try:
+        k = int(req.params.get('k', 10))
+    except ValueError:
+        k = None
+    if k is None or not 1 <= k <= max_batch_size:
+        return json_bad_request(p, 'k must be an integer from 1 to %d' % max_batch_size)
+    ids = [id_from_matrix_specification(random_matrix(*pool), *pool)
+                for i in xrange(k)]
+    json_response(p, {'puzzles': batch_puzzles(ids, secret)})
+
+@app.subapp()
+@webify.urlable()
+def batch_answer_matrix(req, p):
+    secret = req.settings.get('answer_secret', default_answer_secret)
+    try:
+        submissions = simplejson.loads(req.body)
+    except ValueError:
+        return json_bad_request(p, 'body must be json')
+    # list is the /list handler in this module
+    if not isinstance(submissions, type([])):
+        return json_bad_request(p, 'body must be a json list of submissions')
+    if len(submissions) > max_batch_size:
+        return json_bad_request(p, 'at most %d submissions per request' % max_batch_size)
+    results = grade_submissions(secret, submissions)
+    json_response(p, {'results': results,
+                      'correct': len([r for r in results if r.get('correct')])})
+
+
 @app.subapp()
 @webify.urlable()
 def debug(req, p):
@@ -246,7 +458,8 @@ def debug(req, p):
     p(png)
 
 from webify.http import server
-if __name__ == '__main__':
+
+def main():
     mail_server = webify.email.LocalMailServer()
     settings = {
                 'mail_server': mail_server,
@@ -256,6 +469,33 @@ if __name__ == '__main__':
                                         SettingsMiddleware(settings),
                                         EvalException,
                                      )
+    wsgi_app = PngStreamMiddleware(wsgi_app, render_cache)
+
+    parser = argparse.ArgumentParser(description='Serve raven matrices')
+    parser.add_argument('--pooled', action='store_true',
+                        help='offload rendering to a bounded pool, see serve_raven')
+    parser.add_argument('--prewarm', metavar='ACCESS_LOG',
+                        help='warm the most requested ids in this log, or '
+                             '"world" to enumerate every figure and matrix')
+    parser.add_argument('--prewarm-seconds', type=float, default=60)
+    parser.add_argument('--prewarm-bytes', type=int, default=render_cache.max_bytes / 2)
+    args = parser.parse_args()
+
+    if args.prewarm:
+        import prewarm_raven
+        prewarm_raven.start_prewarm(args.prewarm,
+                                    render_cache, render_functions,
+                                    seconds=args.prewarm_seconds,
+                                    max_bytes=args.prewarm_bytes)
 
     print 'Loading server...'
-    server.serve(wsgi_app, host='0.0.0.0', port=8087, reload=True)
+    if args.pooled:
+        import serve_raven
+        serve_raven.serve(wsgi_app, host='0.0.0.0', port=8087, bypass=png_cached)
+    else:
+        server.serve(wsgi_app, host='0.0.0.0', port=8087, reload=True)
+
+if __name__ == '__main__':
+    # prewarm_raven imports web_raven; hand it this module, not a second copy
+    sys.modules.setdefault('web_raven', sys.modules[__name__])
+    main()